@@ -1,13 +1,13 @@
 """Extract features from images for a given structure"""
 
-import copy
 import math
 import warnings
 from abc import abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
 from collections import OrderedDict
 from copy import deepcopy
-from typing import Any, Callable, List, Optional, Tuple, Union
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -16,15 +16,9 @@ import torch
 import torchvision
 from histocartography.preprocessing.tissue_mask import GaussianTissueMask
 from histocartography.utils import dynamic_import_from
+from scipy import ndimage
 from scipy.stats import skew
-try:
-    from skimage.feature import graycomatrix as greycomatrix
-    from skimage.feature import graycoprops as greycoprops
-except ImportError:
-    from skimage.feature import greycomatrix, greycoprops
-from skimage.filters.rank import entropy as Entropy
-from skimage.measure import regionprops
-from skimage.morphology import disk
+from skimage.measure import regionprops, regionprops_table
 from sklearn.metrics.pairwise import euclidean_distances
 from torch import nn
 from torch.utils.data import DataLoader, Dataset
@@ -196,99 +190,100 @@ class HandcraftedFeatureExtractor(FeatureExtractor):
                           Crowdedness: mean_crowdedness, std_crowdedness
 
         """
-        node_feat = []
-
         img_gray = cv2.cvtColor(input_image, cv2.COLOR_RGB2GRAY)
-        img_square = np.square(input_image)
 
         # For each instance
         regions = regionprops(instance_map)
-
-        # pre-extract centroids to compute crowdedness
+        node_feat = np.empty(
+            (len(regions), len(HANDCRAFTED_FEATURES_NAMES)), dtype=np.float32)
+
+        # pre-extract mask-based shape properties of all instances at once
+        shape_table = regionprops_table(
+            instance_map, properties=SHAPE_PROPERTIES_NAMES)
+        area = shape_table["area"]
+        major_axis_length = shape_table["major_axis_length"]
+        minor_axis_length = shape_table["minor_axis_length"]
+        perimeter = shape_table["perimeter"]
+
+        # pre-extract centroids to compute crowdedness [2 features]
         centroids = [r.centroid for r in regions]
         all_mean_crowdedness, all_std_crowdedness = self._compute_crowdedness(
             centroids)
+        mean_crowdedness = HANDCRAFTED_FEATURES_NAMES["mean_crowdedness"]
+        std_crowdedness = HANDCRAFTED_FEATURES_NAMES["std_crowdedness"]
+        node_feat[:, mean_crowdedness:mean_crowdedness + 1] = all_mean_crowdedness
+        node_feat[:, std_crowdedness:std_crowdedness + 1] = all_std_crowdedness
+
+        glcm_features = slice(
+            HANDCRAFTED_FEATURES_NAMES["glcm_contrast"],
+            HANDCRAFTED_FEATURES_NAMES["glcm_dispersion"] + 1,
+        )
 
+        convex_hull_perimeter = np.empty(len(regions))
         for region_id, region in enumerate(regions):
 
-            sp_mask = instance_map[region['bbox'][0]:region['bbox'][2], region['bbox'][1]:region['bbox'][3]] == region['label'] 
-            sp_gray = img_gray[region['bbox'][0]:region['bbox'][2], region['bbox'][1]:region['bbox'][3]] * sp_mask
-
-            # Compute using mask [16 features]
-            area = region["area"]
-            convex_area = region["convex_area"]
-            eccentricity = region["eccentricity"]
-            equivalent_diameter = region["equivalent_diameter"]
-            euler_number = region["euler_number"]
-            extent = region["extent"]
-            filled_area = region["filled_area"]
-            major_axis_length = region["major_axis_length"]
-            minor_axis_length = region["minor_axis_length"]
-            orientation = region["orientation"]
-            perimeter = region["perimeter"]
-            solidity = region["solidity"]
-            convex_hull_perimeter = self._compute_convex_hull_perimeter(sp_mask)
-            roughness = convex_hull_perimeter / perimeter
-            shape_factor = 4 * np.pi * area / convex_hull_perimeter ** 2
-            ellipticity = minor_axis_length / major_axis_length
-            roundness = (4 * np.pi * area) / (perimeter ** 2)
-
-            feats_shape = [
-                area,
-                convex_area,
-                eccentricity,
-                equivalent_diameter,
-                euler_number,
-                extent,
-                filled_area,
-                major_axis_length,
-                minor_axis_length,
-                orientation,
-                perimeter,
-                solidity,
-                roughness,
-                shape_factor,
-                ellipticity,
-                roundness,
-            ]
+            sp_mask = region.image
+            sp_gray = img_gray[region.slice]
 
-            # GLCM texture features (gray color space) [5 features]
-            glcm = greycomatrix(sp_gray, [1], [0])
-            # Filter out the first row and column
-            filt_glcm = glcm[1:, 1:, :, :]
-
-            glcm_contrast = greycoprops(filt_glcm, prop="contrast")
-            glcm_contrast = glcm_contrast[0, 0]
-            glcm_dissimilarity = greycoprops(filt_glcm, prop="dissimilarity")
-            glcm_dissimilarity = glcm_dissimilarity[0, 0]
-            glcm_homogeneity = greycoprops(filt_glcm, prop="homogeneity")
-            glcm_homogeneity = glcm_homogeneity[0, 0]
-            glcm_energy = greycoprops(filt_glcm, prop="energy")
-            glcm_energy = glcm_energy[0, 0]
-            glcm_ASM = greycoprops(filt_glcm, prop="ASM")
-            glcm_ASM = glcm_ASM[0, 0]
-            glcm_dispersion = np.std(filt_glcm)
-
-            feats_texture = [
-                glcm_contrast,
-                glcm_dissimilarity,
-                glcm_homogeneity,
-                glcm_energy,
-                glcm_ASM,
-                glcm_dispersion,
-            ]
+            convex_hull_perimeter[region_id] = self._compute_convex_hull_perimeter(
+                sp_mask)
 
-            feats_crowdedness = [
-                all_mean_crowdedness[region_id],
-                all_std_crowdedness[region_id],
-            ]
+            # GLCM texture features (gray color space) [6 features]
+            node_feat[region_id, glcm_features] = self._compute_glcm_features(
+                sp_gray, sp_mask)
 
-            sp_feats = feats_shape + feats_texture + feats_crowdedness
-            features = np.hstack(sp_feats)
-            node_feat.append(features)
+        # Compute using mask [16 features]
+        for name in SHAPE_PROPERTIES_NAMES:
+            node_feat[:, HANDCRAFTED_FEATURES_NAMES[name]] = shape_table[name]
+        node_feat[:, HANDCRAFTED_FEATURES_NAMES["roughness"]] = convex_hull_perimeter / perimeter
+        node_feat[:, HANDCRAFTED_FEATURES_NAMES["shape_factor"]] = (
+            4 * np.pi * area / convex_hull_perimeter ** 2)
+        node_feat[:, HANDCRAFTED_FEATURES_NAMES["ellipticity"]] = minor_axis_length / major_axis_length
+        node_feat[:, HANDCRAFTED_FEATURES_NAMES["roundness"]] = (4 * np.pi * area) / (perimeter ** 2)
 
-        node_feat = np.vstack(node_feat)
-        return torch.Tensor(node_feat)
+        return torch.from_numpy(node_feat)
+
+    @staticmethod
+    def _compute_glcm_features(sp_gray, sp_mask):
+        """
+        Compute the GLCM texture features of a masked gray patch in a single pass over its
+        co-occurring pixel pairs. Equivalent to building the grey-level co-occurence matrix
+        with distance 1 and angle 0 of the patch zeroed outside the mask, filtering out its
+        first row and column and evaluating contrast, dissimilarity, homogeneity, energy, ASM
+        and dispersion on it, without materializing the 256x256 matrix.
+        """
+        left = sp_gray[:, :-1].ravel().astype(np.int64)
+        right = sp_gray[:, 1:].ravel().astype(np.int64)
+        valid = (sp_mask[:, :-1] & sp_mask[:, 1:]).ravel() & (left > 0) & (right > 0)
+        pairs, counts = np.unique(
+            left[valid] * 256 + right[valid], return_counts=True)
+
+        diff = pairs // 256 - pairs % 256
+        total = counts.sum()
+        probs = counts / (total if total > 0 else 1)
+
+        glcm_contrast = np.sum(probs * diff ** 2)
+        glcm_dissimilarity = np.sum(probs * np.abs(diff))
+        glcm_homogeneity = np.sum(probs / (1.0 + diff ** 2))
+        glcm_ASM = np.sum(probs ** 2)
+        glcm_energy = np.sqrt(glcm_ASM)
+
+        # std over all 255x255 entries of the filtered matrix, most of which are empty
+        nr_entries = 255 * 255
+        mean_count = total / nr_entries
+        glcm_dispersion = np.sqrt(
+            (np.sum((counts - mean_count) ** 2)
+             + (nr_entries - len(counts)) * mean_count ** 2) / nr_entries
+        )
+
+        return [
+            glcm_contrast,
+            glcm_dissimilarity,
+            glcm_homogeneity,
+            glcm_energy,
+            glcm_ASM,
+            glcm_dispersion,
+        ]
 
     @staticmethod
     def _compute_crowdedness(centroids, k=10):
@@ -330,7 +325,9 @@ class PatchFeatureExtractor:
         architecture: str,
         device: torch.device,
         patch_size: int,
-        extraction_layer: Optional[str] = None
+        extraction_layer: Optional[str] = None,
+        use_cuda_graph: bool = False,
+        use_amp: bool = False,
     ) -> None:
         """
         Create a patch feature extracter of a given architecture and put it on GPU if available.
@@ -340,8 +337,20 @@ class PatchFeatureExtractor:
             device (torch.device): Torch Device.
             patch_size (int): Desired size of patch.
             extraction_layer (Optional[str]): Name of the network module from where the features are extracted.
+            use_cuda_graph (bool): If the forward pass should be captured once as a CUDA graph and replayed
+                                   for all batches of the same shape. The graph is re-captured, with three
+                                   warm-up passes, whenever a batch larger than the captured one appears;
+                                   smaller batches run eagerly. The number of captures is tracked in
+                                   nr_graph_captures. Only used on CUDA devices. Defaults to False.
+            use_amp (bool): If the forward pass should run under float16 autocast with channels_last inputs.
+                            Embeddings are returned as float32. Only used on CUDA devices. Defaults to False.
         """
         self.device = device
+        self.use_cuda_graph = use_cuda_graph and self.device.type == "cuda"
+        self._graph = None
+        self._static_patch = None
+        self._static_embeddings = None
+        self.nr_graph_captures = 0
 
         if architecture.startswith("s3://mlflow"):
             model = self._get_mlflow_model(url=architecture)
@@ -352,6 +361,9 @@ class PatchFeatureExtractor:
 
         self._validate_model(model)
         self.model = self._remove_layers(model, extraction_layer)
+        self.use_amp = use_amp and self.device.type == "cuda"
+        if self.use_amp:
+            self.model = self.model.to(memory_format=torch.channels_last)
         self.num_features = self._get_num_features(model, patch_size)
         self.model.eval()
 
@@ -473,14 +485,54 @@ class PatchFeatureExtractor:
         Returns:
             torch.Tensor: Embedding of image.
         """
-        patch = patch.to(self.device)
-        with torch.no_grad():
+        patch = patch.to(self.device, non_blocking=True)
+        if self.use_amp:
+            patch = patch.contiguous(memory_format=torch.channels_last)
+        if self.use_cuda_graph:
+            # (re-)capture for the largest batch seen, smaller last batches run eagerly
+            if self._graph is None or patch.shape[0] > self._static_patch.shape[0]:
+                self._capture_graph(patch)
+            if patch.shape == self._static_patch.shape:
+                self._static_patch.copy_(patch)
+                self._graph.replay()
+                return self._static_embeddings.squeeze().float().clone()
+        with torch.inference_mode(), torch.autocast(
+            device_type=self.device.type, enabled=self.use_amp
+        ):
             embeddings = self.model(patch).squeeze()
-        return embeddings
+        return embeddings.float()
+
+    def _capture_graph(self, patch: torch.Tensor) -> None:
+        """
+        Capture the forward pass for batches with the shape of a given batch as a CUDA graph.
+
+        Args:
+            patch (torch.Tensor): Normalized image input on the device.
+        """
+        self._static_patch = patch.clone()
+        with torch.inference_mode(), torch.autocast(
+            device_type=self.device.type, enabled=self.use_amp, cache_enabled=False
+        ):
+            # warm up on a side stream before capturing, as required by torch.cuda.graph
+            stream = torch.cuda.Stream(device=self.device)
+            stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(stream):
+                for _ in range(3):
+                    self.model(self._static_patch)
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+
+            self._graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self._graph):
+                self._static_embeddings = self.model(self._static_patch)
+        self.nr_graph_captures += 1
 
 
 class InstanceMapPatchDataset(Dataset):
-    """Helper class to use a give image and extracted instance maps as a dataset"""
+    """
+    Helper class to use a give image and extracted instance maps as a dataset.
+    Patches are returned as un-normalized uint8 tensors. Resizing and normalization are
+    done per batch by batch_transform.
+    """
 
     def __init__(
         self,
@@ -509,7 +561,8 @@ class InstanceMapPatchDataset(Dataset):
             fill_value (Optional[int]): Value to fill outside the instance maps. Defaults to 255. 
             mean (list[float], optional): Channel-wise mean for image normalization.
             std (list[float], optional): Channel-wise std for image normalization.
-            transform (Callable): Transform to apply. Defaults to None.
+            transform (Callable): Transform to apply to each patch, given as a uint8 (C, H, W) tensor of size
+                                  patch_size before resizing. Defaults to None.
             with_instance_masking (bool): If pixels outside instance should be masked. Defaults to False.
         """
         self.image = image
@@ -539,54 +592,66 @@ class InstanceMapPatchDataset(Dataset):
         )
         self.patch_size_2 = int(self.patch_size // 2)
         self.threshold = int(self.patch_size * self.patch_size * 0.25)
-        self.properties = regionprops(self.instance_map)
+        self.integral_image_min_candidates = 16
+        self.properties = self._get_properties(self.instance_map)
         self.warning_threshold = 0.75
-        self.patch_coordinates = []
-        self.patch_region_count = []
-        self.patch_instance_ids = []
-        self.patch_overlap = []
 
-        basic_transforms = [transforms.ToPILImage()]
+        # patches are returned as uint8 (C, H, W) tensors, the optional transform is applied per
+        # patch while resizing and normalization are applied to whole batches by batch_transform
+        self.dataset_transform = transform
+        batch_transforms = [transforms.ConvertImageDtype(torch.float32)]
         if self.resize_size is not None:
-            basic_transforms.append(transforms.Resize(self.resize_size))
-        if transform is not None:
-            basic_transforms.append(transform)
-        basic_transforms.append(transforms.ToTensor())
+            batch_transforms.append(
+                transforms.Resize(self.resize_size, antialias=True))
         if self.mean is not None and self.std is not None:
-            basic_transforms.append(transforms.Normalize(self.mean, self.std))
-        self.dataset_transform = transforms.Compose(basic_transforms)
+            batch_transforms.append(transforms.Normalize(self.mean, self.std))
+        self.batch_transform = transforms.Compose(batch_transforms)
 
         self._precompute()
         self._warning()
 
-    def _add_patch(self, center_x: int, center_y: int, instance_index: int, region_count: int) -> None:
+    @staticmethod
+    def _get_properties(instance_map: np.ndarray) -> dict:
         """
-        Extract and include patch information.
+        Compute label, bounding box and centroid of all instances from their find_objects slices,
+        in the same layout as skimage.measure.regionprops_table.
 
         Args:
-            center_x (int): Centroid x-coordinate of the patch wrt. the instance map.
-            center_y (int): Centroid y-coordinate of the patch wrt. the instance map.
-            instance_index (int): Instance index to which the patch belongs.
-            region_count (int): Region count indicates the location of the patch wrt. the list of patch coords.
-        """
-        mask = self.instance_map[
-            center_y - self.patch_size_2: center_y + self.patch_size_2,
-            center_x - self.patch_size_2: center_x + self.patch_size_2
-        ]
-        overlap = np.sum(mask == instance_index)
-        if overlap > self.threshold:
-            loc = [center_x - self.patch_size_2, center_y - self.patch_size_2]
-            self.patch_coordinates.append(loc)
-            self.patch_region_count.append(region_count)
-            self.patch_instance_ids.append(instance_index)
-            self.patch_overlap.append(overlap)
+            instance_map (np.ndarray): Instance map.
 
-    def _get_patch(self, loc: list, region_id: int = None) -> np.ndarray:
+        Returns:
+            dict: Arrays "label", "bbox-0" to "bbox-3", "centroid-0" and "centroid-1".
+        """
+        labels, bboxes, centroids = [], [], []
+        for label, sl in enumerate(ndimage.find_objects(instance_map), start=1):
+            if sl is None:
+                continue
+            instance_mask = instance_map[sl] == label
+            rows = instance_mask.sum(axis=1)
+            cols = instance_mask.sum(axis=0)
+            count = rows.sum()
+            labels.append(label)
+            bboxes.append((sl[0].start, sl[1].start, sl[0].stop, sl[1].stop))
+            centroids.append((
+                rows @ np.arange(sl[0].start, sl[0].stop) / count,
+                cols @ np.arange(sl[1].start, sl[1].stop) / count,
+            ))
+
+        bboxes = np.array(bboxes, dtype=int).reshape(-1, 4)
+        centroids = np.array(centroids, dtype=float).reshape(-1, 2)
+        properties = {"label": np.array(labels, dtype=int)}
+        for i in range(4):
+            properties[f"bbox-{i}"] = bboxes[:, i]
+        properties["centroid-0"] = centroids[:, 0]
+        properties["centroid-1"] = centroids[:, 1]
+        return properties
+
+    def _get_patch(self, loc: np.ndarray, region_id: int = None) -> np.ndarray:
         """
         Extract patch from image.
 
         Args:
-            loc (list): Top-left (x,y) coordinate of a patch.
+            loc (np.ndarray): Top-left (x,y) coordinate of a patch.
             region_id (int): Index of the region being processed. Defaults to None. 
         """
         min_x = loc[0]
@@ -594,62 +659,104 @@ class InstanceMapPatchDataset(Dataset):
         max_x = min_x + self.patch_size
         max_y = min_y + self.patch_size
 
-        patch = copy.deepcopy(self.image[min_y:max_y, min_x:max_x])
+        patch = self.image[min_y:max_y, min_x:max_x]
 
         if self.with_instance_masking:
-            instance_mask = ~(self.instance_map[min_y:max_y, min_x:max_x] == region_id)
-            patch[instance_mask, :] = self.fill_value
+            instance_mask = self.instance_map[min_y:max_y, min_x:max_x] == region_id
+            patch = np.where(
+                instance_mask[:, :, np.newaxis], patch, np.uint8(self.fill_value))
 
         return patch
 
     def _precompute(self):
         """Precompute instance-wise patch information for all instances in the input image."""
-        for region_count, region in enumerate(self.properties):
-
-            # Extract centroid
-            center_y, center_x = region.centroid
-            center_x = int(round(center_x))
-            center_y = int(round(center_y))
-
-            # Extract bounding box
-            min_y, min_x, max_y, max_x = region.bbox
-
-            # Extract patch information around the centroid patch 
-            # quadrant 1 (includes centroid patch)
-            y_ = copy.deepcopy(center_y)
-            while y_ >= min_y:
-                x_ = copy.deepcopy(center_x)
-                while x_ >= min_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ -= self.stride
-                y_ -= self.stride
-
-            # quadrant 4
-            y_ = copy.deepcopy(center_y)
-            while y_ >= min_y:
-                x_ = copy.deepcopy(center_x) + self.stride
-                while x_ <= max_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ += self.stride
-                y_ -= self.stride
-
-            # quadrant 2
-            y_ = copy.deepcopy(center_y) + self.stride
-            while y_ <= max_y:
-                x_ = copy.deepcopy(center_x)
-                while x_ >= min_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ -= self.stride
-                y_ += self.stride
-
-            # quadrant 3
-            y_ = copy.deepcopy(center_y) + self.stride
-            while y_ <= max_y:
-                x_ = copy.deepcopy(center_x) + self.stride
-                while x_ <= max_x:
-                    self._add_patch(x_, y_, region.label, region_count)
-                    x_ += self.stride
-                y_ += self.stride
+        labels = self.properties["label"]
+        min_y, min_x, max_y, max_x = (self.properties[f"bbox-{i}"] for i in range(4))
+        center_y = np.rint(self.properties["centroid-0"]).astype(int)
+        center_x = np.rint(self.properties["centroid-1"]).astype(int)
+
+        # Extract patch centers around the centroid patch of all regions at once, in the order of
+        # quadrant 1 (includes centroid patch), quadrant 4, quadrant 2 and quadrant 3
+        nr_down_y = (center_y - min_y) // self.stride + 1
+        nr_up_y = (max_y - center_y) // self.stride
+        nr_down_x = (center_x - min_x) // self.stride + 1
+        nr_up_x = (max_x - center_x) // self.stride
+        nr_ys = np.stack([nr_down_y, nr_down_y, nr_up_y, nr_up_y], axis=1).ravel()
+        nr_xs = np.stack([nr_down_x, nr_up_x, nr_down_x, nr_up_x], axis=1).ravel()
+        first_y = np.stack(
+            [center_y, center_y, center_y + self.stride, center_y + self.stride], axis=1).ravel()
+        first_x = np.stack(
+            [center_x, center_x + self.stride, center_x, center_x + self.stride], axis=1).ravel()
+        step_y = np.tile([-self.stride, -self.stride, self.stride, self.stride], len(labels))
+        step_x = np.tile([-self.stride, self.stride, -self.stride, self.stride], len(labels))
+
+        block_sizes = nr_ys * nr_xs
+        block = np.repeat(np.arange(len(block_sizes)), block_sizes)
+        position = np.arange(len(block)) - np.repeat(np.cumsum(block_sizes) - block_sizes, block_sizes)
+        ys = first_y[block] + step_y[block] * (position // np.maximum(nr_xs, 1)[block])
+        xs = first_x[block] + step_x[block] * (position % np.maximum(nr_xs, 1)[block])
+        region_count = block // 4
+        instance_ids = labels[region_count]
+
+        # Count the instance pixels of each candidate patch on its window. Regions with many
+        # candidates share one integral image over their neighbourhood instead.
+        overlap = np.empty(len(ys), dtype=int)
+        region_sizes = block_sizes.reshape(-1, 4).sum(axis=1)
+        region_ends = np.cumsum(region_sizes)
+        many_candidates = region_sizes > self.integral_image_min_candidates
+        single_windows = ~many_candidates[region_count]
+        for y, x, label, i in zip(
+                ys[single_windows].tolist(),
+                xs[single_windows].tolist(),
+                instance_ids[single_windows].tolist(),
+                np.flatnonzero(single_windows).tolist()):
+            window = self.instance_map[
+                y - self.patch_size_2: y + self.patch_size_2,
+                x - self.patch_size_2: x + self.patch_size_2
+            ]
+            overlap[i] = np.count_nonzero(window == label)
+        for region in np.flatnonzero(many_candidates):
+            candidates = slice(region_ends[region] - region_sizes[region], region_ends[region])
+            overlap[candidates] = self._count_overlaps(
+                ys[candidates], xs[candidates], labels[region])
+
+        valid = overlap > self.threshold
+        self.patch_coordinates = np.stack(
+            [xs[valid] - self.patch_size_2, ys[valid] - self.patch_size_2], axis=1)
+        self.patch_region_count = region_count[valid]
+        self.patch_instance_ids = instance_ids[valid]
+        self.patch_overlap = overlap[valid]
+
+    def _count_overlaps(self, ys: np.ndarray, xs: np.ndarray, label: int) -> np.ndarray:
+        """
+        Count the pixels of an instance in the patches centered at the given coordinates
+        with an integral image over the neighbourhood of all patches.
+
+        Args:
+            ys (np.ndarray): Patch center y-coordinates wrt. the instance map.
+            xs (np.ndarray): Patch center x-coordinates wrt. the instance map.
+            label (int): Instance label.
+
+        Returns:
+            np.ndarray: Number of instance pixels in each patch.
+        """
+        min_row = ys.min() - self.patch_size_2
+        min_col = xs.min() - self.patch_size_2
+        instance_mask = self.instance_map[
+            min_row: ys.max() + self.patch_size_2,
+            min_col: xs.max() + self.patch_size_2
+        ] == label
+        integral = np.zeros(
+            (instance_mask.shape[0] + 1, instance_mask.shape[1] + 1), dtype=int)
+        integral[1:, 1:] = instance_mask.cumsum(axis=0).cumsum(axis=1)
+        top = ys - self.patch_size_2 - min_row
+        left = xs - self.patch_size_2 - min_col
+        bottom = top + 2 * self.patch_size_2
+        right = left + 2 * self.patch_size_2
+        return (
+            integral[bottom, right] - integral[top, right]
+            - integral[bottom, left] + integral[top, left]
+        )
 
     def _warning(self):
         """Check patch coverage statistics to identify if provided patch size includes too much background."""
@@ -669,13 +776,16 @@ class InstanceMapPatchDataset(Dataset):
             index (int): Patch index.
 
         Returns:
-            Tuple[int, torch.Tensor]: instance_index, image as tensor.
+            Tuple[int, torch.Tensor]: instance_index, un-normalized uint8 (C, H, W) image as tensor.
+                                      batch_transform still has to be applied to the collated batch.
         """
         patch = self._get_patch(
             self.patch_coordinates[index],
             self.patch_instance_ids[index]
         )
-        patch = self.dataset_transform(patch)
+        patch = torch.from_numpy(patch).permute(2, 0, 1)
+        if self.dataset_transform is not None:
+            patch = self.dataset_transform(patch)
         return self.patch_region_count[index], patch
 
     def __len__(self) -> int:
@@ -705,6 +815,8 @@ class DeepFeatureExtractor(FeatureExtractor):
         verbose: bool = False,
         with_instance_masking: bool = False,
         extraction_layer: str = None,
+        use_cuda_graph: bool = False,
+        use_amp: bool = False,
         **kwargs,
     ) -> None:
         """
@@ -724,6 +836,14 @@ class DeepFeatureExtractor(FeatureExtractor):
             num_workers (int): Number of workers in data loader. Defaults to 0.
             verbose (bool): tqdm processing bar. Defaults to False.
             with_instance_masking (bool): If pixels outside instance should be masked. Defaults to False.
+            extraction_layer (str): Name of the network module from where the features are extracted.
+                                    Defaults to None.
+            use_cuda_graph (bool): If batches of patches should be processed by replaying a captured CUDA graph.
+                                   Only batches of the largest size seen so far are replayed, and every new
+                                   largest size costs a re-capture with three warm-up passes. Only used on
+                                   CUDA devices. Defaults to False.
+            use_amp (bool): If the network should run under float16 autocast. Only used on CUDA devices.
+                            Defaults to False.
         """
         self.architecture = self._preprocess_architecture(architecture)
         self.patch_size = patch_size
@@ -752,22 +872,41 @@ class DeepFeatureExtractor(FeatureExtractor):
             self.normalizer_mean = [0.485, 0.456, 0.406]
             self.normalizer_std = [0.229, 0.224, 0.225]
         self.patch_feature_extractor = PatchFeatureExtractor(
-            architecture, device=self.device, patch_size=patch_size, extraction_layer=extraction_layer
+            architecture,
+            device=self.device,
+            patch_size=patch_size,
+            extraction_layer=extraction_layer,
+            use_cuda_graph=use_cuda_graph,
+            use_amp=use_amp,
         )
         self.fill_value = fill_value
         self.batch_size = batch_size
         self.architecture_unprocessed = architecture
         self.num_workers = num_workers
-        if self.num_workers in [0, 1]:
-            torch.set_num_threads(1)
 
     def _collate_patches(self, batch):
         """Patch collate function"""
-        instance_indices = [item[0] for item in batch]
+        instance_indices = torch.as_tensor([item[0] for item in batch])
         patches = [item[1] for item in batch]
         patches = torch.stack(patches)
         return instance_indices, patches
 
+    def _features_shape(self) -> Tuple[int, ...]:
+        """Shape of the features extracted per instance"""
+        return (self.patch_feature_extractor.num_features,)
+
+    def _augment_patches(self, patches: torch.Tensor) -> torch.Tensor:
+        """
+        Augment a batch of patches on the device before resizing and normalization.
+
+        Args:
+            patches (torch.Tensor): Batch of uint8 patches of shape [nr_patches, 3, patch_size, patch_size].
+
+        Returns:
+            torch.Tensor: Batch of patches to embed, all views of a patch following each other.
+        """
+        return patches
+
     def _extract_features(
         self,
         input_image: np.ndarray,
@@ -806,30 +945,34 @@ class DeepFeatureExtractor(FeatureExtractor):
             shuffle=False,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
+            pin_memory=self.device.type == "cuda",
             collate_fn=self._collate_patches
         )
-        features = torch.empty(
-            size=(
-                len(image_dataset.properties),
-                self.patch_feature_extractor.num_features,
-            ),
+        features = torch.zeros(
+            size=(len(image_dataset.properties["label"]), *self._features_shape()),
             dtype=torch.float32,
             device=self.device,
         )
-        embeddings = dict()
-        for instance_indices, patches in tqdm(
-            image_loader, total=len(image_loader), disable=not self.verbose
-        ):
-            emb = self.patch_feature_extractor(patches)
-            for j, key in enumerate(instance_indices):
-                if key in embeddings:
-                    embeddings[key][0] += emb[j]
-                    embeddings[key][1] += 1
-                else:
-                    embeddings[key] = [emb[j], 1]
-
-        for k, v in embeddings.items():
-            features[k, :] = v[0] / v[1]
+        with _limit_num_threads(self.num_workers):
+            for instance_indices, patches in tqdm(
+                image_loader, total=len(image_loader), disable=not self.verbose
+            ):
+                patches = self._augment_patches(
+                    patches.to(self.device, non_blocking=True))
+                patches = image_dataset.batch_transform(patches)
+                emb = self.patch_feature_extractor(patches)
+                emb = emb.reshape(len(instance_indices), *features.shape[1:])
+                features.index_add_(
+                    0, instance_indices.to(self.device, non_blocking=True), emb)
+
+        # average the embeddings of all patches belonging to the same instance
+        nr_patches = np.bincount(
+            image_dataset.patch_region_count, minlength=features.shape[0]
+        )
+        nr_patches = torch.as_tensor(
+            np.maximum(nr_patches, 1), dtype=torch.float32, device=self.device
+        )
+        features /= nr_patches.reshape(-1, *[1] * (features.dim() - 1))
 
         return features.cpu().detach()
 
@@ -862,33 +1005,22 @@ class AugmentedDeepFeatureExtractor(DeepFeatureExtractor):
             output_size=(self.patch_size, self.patch_size),
         )
 
-    def _extract_features(
-        self,
-        input_image: np.ndarray,
-        instance_map: np.ndarray,
-        transform: Optional[Callable] = None
-    ) -> torch.Tensor:
+    def _features_shape(self) -> Tuple[int, ...]:
+        """Shape of the features extracted per instance, [nr_augmentations, nr_features]"""
+        return (len(self.transforms), self.patch_feature_extractor.num_features)
+
+    def _augment_patches(self, patches: torch.Tensor) -> torch.Tensor:
         """
-        Extract features for a given RGB image and its extracted instance_map for all augmentations.
+        Apply all augmentations to a batch of patches at once, so that every patch is only cropped once.
 
         Args:
-            input_image (np.ndarray): RGB input image.
-            instance_map (np.ndarray): Extracted instance_map.
-            transform (Callable): Transform to apply. Defaults to None.
+            patches (torch.Tensor): Batch of uint8 patches of shape [nr_patches, 3, patch_size, patch_size].
 
         Returns:
-            torch.Tensor: Extracted features of shape [nr_instances, nr_augmentations, nr_features].
+            torch.Tensor: Augmented patches of shape [nr_patches * nr_augmentations, 3, patch_size, patch_size].
         """
-
-        all_features = list()
-        for transform in self.transforms:
-            features = super()._extract_features(
-                input_image, instance_map, transform=transform)
-            all_features.append(features)
-
-        all_features = torch.stack(all_features)
-        all_features = all_features.permute(1, 0, 2)
-        return all_features
+        patches = torch.stack([transform(patches) for transform in self.transforms], dim=1)
+        return patches.flatten(0, 1)
 
 
 class GridPatchDataset(Dataset):
@@ -1031,6 +1163,8 @@ class GridDeepFeatureExtractor(FeatureExtractor):
         num_workers: int = 0,
         verbose: bool = False,
         extraction_layer: str = None,
+        use_cuda_graph: bool = False,
+        use_amp: bool = False,
         **kwargs,
     ) -> None:
         """
@@ -1049,6 +1183,14 @@ class GridDeepFeatureExtractor(FeatureExtractor):
             fill_value (int): Constant pixel value for image padding. Defaults to 255.
             num_workers (int): Number of workers in data loader. Defaults to 0.
             verbose (bool): tqdm processing bar. Defaults to False.
+            extraction_layer (str): Name of the network module from where the features are extracted.
+                                    Defaults to None.
+            use_cuda_graph (bool): If batches of patches should be processed by replaying a captured CUDA graph.
+                                   Only batches of the largest size seen so far are replayed, and every new
+                                   largest size costs a re-capture with three warm-up passes. Only used on
+                                   CUDA devices. Defaults to False.
+            use_amp (bool): If the network should run under float16 autocast. Only used on CUDA devices.
+                            Defaults to False.
         """
         self.architecture = self._preprocess_architecture(architecture)
         self.patch_size = patch_size
@@ -1080,14 +1222,17 @@ class GridDeepFeatureExtractor(FeatureExtractor):
             self.normalizer_mean = [0.485, 0.456, 0.406]
             self.normalizer_std = [0.229, 0.224, 0.225]
         self.patch_feature_extractor = PatchFeatureExtractor(
-            architecture, device=self.device, patch_size=patch_size, extraction_layer=extraction_layer
+            architecture,
+            device=self.device,
+            patch_size=patch_size,
+            extraction_layer=extraction_layer,
+            use_cuda_graph=use_cuda_graph,
+            use_amp=use_amp,
         )
         self.batch_size = batch_size
         self.fill_value = fill_value
         self.architecture_unprocessed = architecture
         self.num_workers = num_workers
-        if self.num_workers in [0, 1]:
-            torch.set_num_threads(1)
 
     def _collate_patches(self, batch):
         """Patch collate function"""
@@ -1131,6 +1276,7 @@ class GridDeepFeatureExtractor(FeatureExtractor):
             shuffle=False,
             batch_size=self.batch_size,
             num_workers=self.num_workers,
+            pin_memory=self.device.type == "cuda",
             collate_fn=self._collate_patches
         )
         features = torch.empty(
@@ -1140,11 +1286,12 @@ class GridDeepFeatureExtractor(FeatureExtractor):
             dtype=torch.float32,
             device=self.device,
         )
-        for i, patches in tqdm(
-            patch_loader, total=len(patch_loader), disable=not self.verbose
-        ):
-            embeddings = self.patch_feature_extractor(patches)
-            features[i, :] = embeddings
+        with _limit_num_threads(self.num_workers):
+            for i, patches in tqdm(
+                patch_loader, total=len(patch_loader), disable=not self.verbose
+            ):
+                embeddings = self.patch_feature_extractor(patches)
+                features[i, :] = embeddings
         return (
             features.cpu()
             .detach()
@@ -1258,6 +1405,7 @@ class MaskedGridDeepFeatureExtractor(GridDeepFeatureExtractor):
                                   shuffle=False,
                                   batch_size=self.batch_size,
                                   num_workers=self.num_workers,
+                                  pin_memory=self.device.type == "cuda",
                                   collate_fn=self._collate_patches)
 
         # create dictionaries where the keys are the patch indices
@@ -1270,16 +1418,17 @@ class MaskedGridDeepFeatureExtractor(GridDeepFeatureExtractor):
         # extract features of all patches and record which patches are (in)valid
         indices = list(all_features.keys())
         offset = 0
-        for _, img_patches, mask_patches in tqdm(patch_loader,
-                                                 total=len(patch_loader),
-                                                 disable=not self.verbose):
-            index_filter, features = self._validate_and_extract_features(img_patches, mask_patches)
-            if len(img_patches) == 1:
-                features = features.unsqueeze(dim=0)
-            for i in range(len(index_filter)):
-                all_index_filter[indices[offset+i]] = index_filter[i]
-                all_features[indices[offset+i]] = features[i].cpu().detach().numpy()
-            offset += len(index_filter)
+        with _limit_num_threads(self.num_workers):
+            for _, img_patches, mask_patches in tqdm(patch_loader,
+                                                     total=len(patch_loader),
+                                                     disable=not self.verbose):
+                index_filter, features = self._validate_and_extract_features(img_patches, mask_patches)
+                if len(img_patches) == 1:
+                    features = features.unsqueeze(dim=0)
+                for i in range(len(index_filter)):
+                    all_index_filter[indices[offset+i]] = index_filter[i]
+                    all_features[indices[offset+i]] = features[i].cpu().detach().numpy()
+                offset += len(index_filter)
 
         # convert to pandas dataframes to allow storing as .h5 files
         all_index_filter = pd.DataFrame(all_index_filter, index=['is_valid'])
@@ -1317,6 +1466,7 @@ class MaskedGridDeepFeatureExtractor(GridDeepFeatureExtractor):
         features = self.patch_feature_extractor(img_patches)
         return index_filter, features
 
+
 def _build_augmentations(
     rotations: Optional[List[int]] = None,
     flips: Optional[List[Any]] = None,
@@ -1348,7 +1498,9 @@ def _build_augmentations(
                 t = [
                     transforms.Lambda(
                         lambda x,
-                        a=angle: transforms.functional.rotate(
+                        a=angle: torch.rot90(x, k=a // 90, dims=(-2, -1))
+                        if isinstance(x, torch.Tensor)
+                        else transforms.functional.rotate(
                             x,
                             angle=a))]
             else:
@@ -1405,6 +1557,40 @@ def _get_pad_size(size: int, patch_size: int, stride: int) -> Tuple[int, int]:
     return top_pad, bottom_pad
 
 
+@contextmanager
+def _limit_num_threads(num_workers: int) -> Iterator[None]:
+    """Use a single torch thread while patches are loaded in the main process (num_workers in [0, 1]),
+    restoring the previous number of threads afterwards.
+
+    Args:
+        num_workers (int): Number of workers of the data loader.
+    """
+    if num_workers not in [0, 1]:
+        yield
+        return
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(num_threads)
+
+
+SHAPE_PROPERTIES_NAMES = (
+    "area",
+    "convex_area",
+    "eccentricity",
+    "equivalent_diameter",
+    "euler_number",
+    "extent",
+    "filled_area",
+    "major_axis_length",
+    "minor_axis_length",
+    "orientation",
+    "perimeter",
+    "solidity",
+)
+
 HANDCRAFTED_FEATURES_NAMES = {
     "area": 0,
     "convex_area": 1,
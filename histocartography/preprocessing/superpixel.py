@@ -263,23 +263,21 @@ class MergedSuperpixelExtractor(SuperpixelExtractor):
         if tissue_mask is not None:
             # Remove superpixels belonging to background or having < 10% tissue
             # content
-            ids_initial = np.unique(initial_superpixels, return_counts=True)
-            ids_masked = np.unique(
-                tissue_mask * initial_superpixels, return_counts=True
-            )
-
-            ctr = 1
-            superpixels = np.zeros_like(initial_superpixels)
-            for i in range(len(ids_initial[0])):
-                id = ids_initial[0][i]
-                if id in ids_masked[0]:
-                    idx = np.where(id == ids_masked[0])[0]
-                    ratio = ids_masked[1][idx] / ids_initial[1][i]
-                    if ratio >= 0.1:
-                        superpixels[initial_superpixels == id] = ctr
-                        ctr += 1
-
-            initial_superpixels = superpixels
+            counts_initial = np.bincount(initial_superpixels.ravel())
+            counts_masked = np.bincount(
+                (tissue_mask * initial_superpixels).ravel(),
+                minlength=len(counts_initial),
+            )[: len(counts_initial)]
+
+            ids = np.flatnonzero(counts_initial)
+            ratio = counts_masked[ids] / counts_initial[ids]
+            ids = ids[ratio >= 0.1]
+
+            # relabel the kept superpixels consecutively in a single lookup
+            translator = np.zeros(
+                len(counts_initial), dtype=initial_superpixels.dtype)
+            translator[ids] = np.arange(1, len(ids) + 1)
+            initial_superpixels = translator[initial_superpixels]
 
         # Merge superpixels within tissue region
         g = self._generate_graph(input_image, initial_superpixels)
@@ -7,12 +7,48 @@ from typing import Any, Tuple, Union
 import cv2
 import numpy as np
 from PIL import Image
-from scipy import ndimage
-from skimage.filters import gaussian, threshold_otsu
+from skimage.filters import threshold_otsu
 
 Image.MAX_IMAGE_PIXELS = 100000000000
 
 
+def _threshold_otsu_nonzero(thumbnail: np.ndarray) -> Union[int, float]:
+    """Otsu threshold of the non-zero pixels of a thumbnail, as threshold_otsu(thumbnail[thumbnail > 0]).
+       uint8 thumbnails are thresholded from their histogram without collecting the pixels first.
+       Thumbnails are only uint8 without smoothing (get_tissue_mask with its default sigma=0.0):
+       the smoothed float32 thumbnails of GaussianTissueMask (sigma=20 by default) are passed
+       to threshold_otsu unchanged.
+
+    Args:
+        thumbnail (np.ndarray): (m, n) grayscale thumbnail
+
+    Raises:
+        ValueError: If all values are zero
+
+    Returns:
+        Union[int, float]: Threshold value
+    """
+    if thumbnail.dtype != np.uint8:
+        return threshold_otsu(thumbnail[thumbnail > 0])
+
+    counts = np.bincount(thumbnail.ravel(), minlength=256)
+    values = np.flatnonzero(counts[1:]) + 1
+    if len(values) == 0:
+        raise ValueError("All values are zero")
+    if len(values) == 1:
+        return values[0]
+
+    # same computation as skimage.filters.threshold_otsu on the trimmed histogram
+    bin_centers = np.arange(values[0], values[-1] + 1)
+    counts = counts[bin_centers].astype(np.float32)
+    weight1 = np.cumsum(counts)
+    weight2 = np.cumsum(counts[::-1])[::-1]
+    mean1 = np.cumsum(counts * bin_centers) / weight1
+    mean2 = (np.cumsum((counts * bin_centers)[::-1]) / weight2[::-1])[::-1]
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return bin_centers[np.argmax(variance12)]
+
+
 def get_tissue_mask(
     image: np.ndarray,
     n_thresholding_steps: int = 1,
@@ -43,44 +79,64 @@ def get_tissue_mask(
     else:
         thumbnail = image
 
-    if len(np.unique(thumbnail)) == 1:
+    # constant thumbnail, avoids sorting all pixels as np.unique would
+    if thumbnail.min() == thumbnail.max():
         return None, None
 
+    # restrict the analysis to the bounding box of the non-white pixels, extended by the
+    # support of all smoothing steps, as all pixels outside of it remain zero
+    radius = int(4 * sigma + 0.5) if sigma > 0.0 else 0
+    margin = n_thresholding_steps * radius
+    rows = np.flatnonzero(thumbnail.any(axis=1))
+    cols = np.flatnonzero(thumbnail.any(axis=0))
+    min_row, max_row = max(rows[0] - margin, 0), rows[-1] + margin + 1
+    min_col, max_col = max(cols[0] - margin, 0), cols[-1] + margin + 1
+    full_shape = thumbnail.shape[:2]
+    thumbnail = thumbnail[min_row:max_row, min_col:max_col]
+
     for _ in range(n_thresholding_steps):
 
         # gaussian smoothing of grayscale thumbnail
         if sigma > 0.0:
-            thumbnail = gaussian(
-                thumbnail,
-                sigma=sigma,
-                output=None,
-                mode="nearest",
-                preserve_range=True)
+            # same kernel support as skimage.filters.gaussian (truncate=4)
+            ksize = 2 * radius + 1
+            thumbnail = cv2.GaussianBlur(
+                thumbnail.astype(np.float32),
+                (ksize, ksize),
+                sigmaX=sigma,
+                sigmaY=sigma,
+                borderType=cv2.BORDER_REPLICATE)
 
         # get threshold to keep analysis region
         try:
-            thresh = threshold_otsu(thumbnail[thumbnail > 0])
+            thresh = _threshold_otsu_nonzero(thumbnail)
         except ValueError:  # all values are zero
             thresh = 0
 
         # replace pixels outside analysis region with upper quantile pixels
-        thumbnail[thumbnail < thresh] = 0
+        # (without writing into a grayscale input image)
+        thumbnail = np.where(thumbnail < thresh, 0, thumbnail)
 
     # convert to binary
-    mask = 0 + (thumbnail > 0)
+    mask = (thumbnail > 0).view(np.uint8)
 
-    # find connected components
-    labeled, _ = ndimage.label(mask)
+    # find connected components (4-connectivity, as scipy.ndimage.label)
+    nr_labels, labeled, stats, _ = cv2.connectedComponentsWithStats(
+        mask, connectivity=4)
+    counts = stats[1:, cv2.CC_STAT_AREA]
 
     # only keep
-    unique, counts = np.unique(labeled[labeled > 0], return_counts=True)
-    if len(unique) != 0:
-        discard = np.in1d(labeled, unique[counts < min_size])
-        discard = discard.reshape(labeled.shape)
-        labeled[discard] = 0
+    if nr_labels > 1:
+        # look up the small components in a per-label table
+        discard = np.zeros(nr_labels, dtype=bool)
+        discard[1:] = counts < min_size
+        labeled[discard[labeled]] = 0
         # largest tissue region
-        mask = labeled == unique[np.argmax(counts)]
-        return labeled, mask
+        mask = np.zeros(full_shape, dtype=bool)
+        mask[min_row:max_row, min_col:max_col] = labeled == 1 + np.argmax(counts)
+        full_labeled = np.zeros(full_shape, dtype=labeled.dtype)
+        full_labeled[min_row:max_row, min_col:max_col] = labeled
+        return full_labeled, mask
     else:
         return None, None
 
@@ -91,7 +147,8 @@ class TissueMask(PipelineStep):
             *args,
             output_name: str,
             **kwargs) -> np.ndarray:
-        """Process and save in the provided path as a png image
+        """Process and save in the provided path as a .npy file. Masks previously
+           cached as png images are still reused.
 
         Args:
             output_name (str): Name of output file
@@ -99,7 +156,8 @@ class TissueMask(PipelineStep):
         assert (
             self.save_path is not None
         ), "Can only save intermediate output if base_path was not None during construction"
-        output_path = self.output_dir / f"{output_name}.png"
+        output_path = self.output_dir / f"{output_name}.npy"
+        legacy_output_path = self.output_dir / f"{output_name}.png"
         if output_path.exists():
             logging.info(
                 "%s: Output of %s already exists, using it instead of recomputing",
@@ -107,16 +165,25 @@ class TissueMask(PipelineStep):
                 output_name,
             )
             try:
-                with Image.open(output_path) as input_file:
+                output = np.load(output_path)
+            except (OSError, ValueError) as error:
+                logging.critical("Could not open %s", output_path)
+                raise error
+        elif legacy_output_path.exists():
+            logging.info(
+                "%s: Output of %s already exists, using it instead of recomputing",
+                self.__class__.__name__,
+                output_name,
+            )
+            try:
+                with Image.open(legacy_output_path) as input_file:
                     output = np.array(input_file)
             except OSError as error:
-                logging.critical("Could not open %s", output_path)
+                logging.critical("Could not open %s", legacy_output_path)
                 raise error
         else:
             output = self._process(*args, **kwargs)
-            # with Image.fromarray(np.uint8(output*255)) as output_image:
-            with Image.fromarray(output) as output_image:
-                output_image.save(output_path)
+            np.save(output_path, output)
         return output
 
     def precompute(
@@ -167,7 +234,9 @@ class GaussianTissueMask(TissueMask):
         self.background_gray_value = background_gray_value
         self.downsampling_factor = downsampling_factor
         super().__init__(**kwargs)
-        self.kernel = np.ones((self.kernel_size, self.kernel_size), "uint8")
+        # rectangular element, dilated with OpenCV's separable row/column filter
+        self.kernel = cv2.getStructuringElement(
+            cv2.MORPH_RECT, (self.kernel_size, self.kernel_size))
 
     @staticmethod
     def _downsample(image: np.ndarray, downsampling_factor: int) -> np.ndarray:
@@ -217,36 +286,47 @@ class GaussianTissueMask(TissueMask):
         if self.downsampling_factor != 1:
             image = self._downsample(image, self.downsampling_factor)
 
-        tissue_mask = np.zeros(shape=(image.shape[0], image.shape[1]))
+        tissue_mask = np.zeros(shape=(image.shape[0], image.shape[1]), dtype=np.uint8)
         image_gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        # inverted grayscale thumbnail as computed by get_tissue_mask, detected tissue is
+        # removed from it (white in the image) instead of writing into the input image
+        thumbnail = 255 - cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # output buffer of the dilation, reused across iterations
+        dilated_mask = np.empty_like(tissue_mask)
 
         # Detect tissue region
         while True:
             _, mask_ = get_tissue_mask(
-                image,
+                thumbnail,
                 n_thresholding_steps=self.n_thresholding_steps,
                 sigma=self.sigma,
                 min_size=self.min_size,
             )
-            if mask_ is None:
+            # stop once no component of at least min_size pixels is left, as the
+            # empty mask would only lead to the mean of no pixels below
+            if mask_ is None or not mask_.any():
                 break
             mask_ = cv2.dilate(
-                mask_.astype(
-                    np.uint8),
+                mask_.view(np.uint8),
                 self.kernel,
+                dst=dilated_mask,
                 iterations=self.dilation_steps)
-            image_masked = mask_ * image_gray
+            image_masked = cv2.bitwise_and(image_gray, image_gray, mask=mask_)
 
-            if image_masked[image_masked > 0].mean(
-            ) < self.background_gray_value:
-                tissue_mask[mask_ != 0] = 1
-                image[mask_ != 0] = (255, 255, 255)
+            # mean gray value of the non-zero masked pixels
+            nr_pixels = cv2.countNonZero(image_masked)
+            if nr_pixels == 0:
+                break
+            if cv2.sumElems(image_masked)[0] / nr_pixels < self.background_gray_value:
+                new_tissue = mask_ != 0
+                tissue_mask[new_tissue] = 1
+                thumbnail[new_tissue] = 0
             else:
                 break
-        tissue_mask = tissue_mask.astype(np.uint8)
 
-        tissue_mask = self._upsample(
-            tissue_mask, original_height, original_width)
+        if self.downsampling_factor != 1:
+            tissue_mask = self._upsample(
+                tissue_mask, original_height, original_width)
         return tissue_mask
 
 
@@ -265,9 +345,10 @@ class AnnotationPostProcessor(PipelineStep):
     def _process(  # type: ignore[override]
         self, annotation: np.ndarray, tissue_mask: np.ndarray
     ) -> np.ndarray:
-        annotation = annotation.copy()
-        annotation[~tissue_mask.astype(bool)] = self.background_index
-        return annotation
+        return np.where(
+            tissue_mask.astype(bool),
+            annotation,
+            annotation.dtype.type(self.background_index))
 
     def _process_and_save(
             self,
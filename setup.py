@@ -11,14 +11,14 @@ from distutils.command.build import build as _build
 
 VCS_REQUIREMENTS = []
 PYPI_REQUIREMENTS = [
-    "torch>=1.3.1",
+    "torch>=1.12.0",
     "tqdm>=4.35.0",
     "pandas>=0.24.2",
     "matplotlib>=3.1.1",
     "h5py>=2.9.0",
     "scikit-learn>=0.22",
     "seaborn>=0.9.0",
-    "torchvision>=0.4.0",
+    "torchvision>=0.13.0",
     "pillow>=7.2.0",
     "opencv-python>=3.4.8.29",
     "scikit-image>=0.17.2",
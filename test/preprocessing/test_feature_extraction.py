@@ -5,11 +5,23 @@ import pandas as pd
 import yaml
 import os
 import torch
+import torchvision
 import shutil
+import tempfile
+import warnings
+from skimage.measure import regionprops, regionprops_table
 
 from histocartography import PipelineRunner
+from histocartography.preprocessing import HandcraftedFeatureExtractor
+from histocartography.preprocessing.feature_extraction import InstanceMapPatchDataset, PatchFeatureExtractor
 from histocartography.utils import download_test_data
 
+try:
+    from skimage.feature import graycomatrix, graycoprops
+except ImportError:
+    from skimage.feature import greycomatrix as graycomatrix
+    from skimage.feature import greycoprops as graycoprops
+
 
 class FeatureExtractionTestCase(unittest.TestCase):
     """FeatureExtractionTestCase class."""
@@ -338,6 +350,188 @@ class FeatureExtractionTestCase(unittest.TestCase):
         """Tear down the tests."""
 
 
+class GLCMFeaturesTestCase(unittest.TestCase):
+    """GLCMFeaturesTestCase class."""
+
+    @staticmethod
+    def _reference_glcm_features(sp_gray, sp_mask):
+        """GLCM features as computed with skimage on the masked patch."""
+        glcm = graycomatrix(sp_gray * sp_mask, [1], [0])
+        filt_glcm = glcm[1:, 1:, :, :]
+        features = [
+            graycoprops(filt_glcm, prop=prop)[0, 0]
+            for prop in ["contrast", "dissimilarity", "homogeneity", "energy", "ASM"]
+        ]
+        features.append(np.std(filt_glcm))
+        return features
+
+    def test_glcm_features_match_skimage(self):
+        """
+        Test the fused GLCM features against skimage on random masked patches.
+        """
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            height, width = rng.integers(2, 30, size=2)
+            sp_gray = rng.integers(0, 256, size=(height, width)).astype(np.uint8)
+            sp_mask = rng.random((height, width)) > 0.3
+            np.testing.assert_allclose(
+                HandcraftedFeatureExtractor._compute_glcm_features(sp_gray, sp_mask),
+                self._reference_glcm_features(sp_gray, sp_mask),
+                rtol=1e-10,
+                atol=1e-12,
+            )
+
+    def test_glcm_features_special_regions(self):
+        """
+        Test the fused GLCM features on an empty mask, a one-pixel region and
+        a region containing gray value 0.
+        """
+        rng = np.random.default_rng(1)
+        sp_gray = rng.integers(1, 256, size=(8, 9)).astype(np.uint8)
+
+        empty_mask = np.zeros((8, 9), dtype=bool)
+        one_pixel_mask = np.zeros((8, 9), dtype=bool)
+        one_pixel_mask[3, 4] = True
+
+        zero_gray = sp_gray.copy()
+        zero_gray[2:5, 1:7] = 0
+        full_mask = np.ones((8, 9), dtype=bool)
+
+        for gray, mask in [
+            (sp_gray, empty_mask),
+            (sp_gray, one_pixel_mask),
+            (zero_gray, full_mask),
+            (np.zeros((1, 1), dtype=np.uint8), np.ones((1, 1), dtype=bool)),
+        ]:
+            np.testing.assert_allclose(
+                HandcraftedFeatureExtractor._compute_glcm_features(gray, mask),
+                self._reference_glcm_features(gray, mask),
+                rtol=1e-10,
+                atol=1e-12,
+            )
+
+
+class InstanceMapPatchDatasetTestCase(unittest.TestCase):
+    """InstanceMapPatchDatasetTestCase class."""
+
+    @staticmethod
+    def _reference_patches(dataset):
+        """Patch information as computed by scanning the quadrants around every regionprops centroid."""
+        patches = []
+
+        def add_patch(center_x, center_y, label, region_count):
+            mask = dataset.instance_map[
+                center_y - dataset.patch_size_2: center_y + dataset.patch_size_2,
+                center_x - dataset.patch_size_2: center_x + dataset.patch_size_2
+            ]
+            overlap = np.sum(mask == label)
+            if overlap > dataset.threshold:
+                patches.append((
+                    center_x - dataset.patch_size_2,
+                    center_y - dataset.patch_size_2,
+                    region_count,
+                    label,
+                    overlap,
+                ))
+
+        stride = dataset.stride
+        for region_count, region in enumerate(regionprops(dataset.instance_map)):
+            center_y, center_x = region.centroid
+            center_x = int(round(center_x))
+            center_y = int(round(center_y))
+            min_y, min_x, max_y, max_x = region.bbox
+            # quadrants 1, 4, 2 and 3
+            for ys, xs in [
+                (range(center_y, min_y - 1, -stride), range(center_x, min_x - 1, -stride)),
+                (range(center_y, min_y - 1, -stride), range(center_x + stride, max_x + 1, stride)),
+                (range(center_y + stride, max_y + 1, stride), range(center_x, min_x - 1, -stride)),
+                (range(center_y + stride, max_y + 1, stride), range(center_x + stride, max_x + 1, stride)),
+            ]:
+                for y in ys:
+                    for x in xs:
+                        add_patch(x, y, region.label, region_count)
+        return np.array(patches, dtype=int).reshape(-1, 5)
+
+    def test_precompute_matches_reference(self):
+        """
+        Test the precomputed patch information against a per-patch reference
+        on an instance map with a label gap and a one-pixel instance.
+        """
+        rng = np.random.default_rng(0)
+        instance_map = np.zeros((40, 50), dtype=np.int32)
+        instance_map[2:18, 3:20] = 1
+        instance_map[5:30, 25:47] = 2
+        instance_map[22:37, 4:21] = 5   # labels 3 and 4 are missing
+        instance_map[33, 40] = 7        # one-pixel instance
+        instance_map[rng.random(instance_map.shape) < 0.05] = 0
+        image = rng.integers(0, 256, size=(40, 50, 3)).astype(np.uint8)
+
+        for patch_size, stride in [(8, 8), (7, 3), (10, 4), (5, 5)]:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                dataset = InstanceMapPatchDataset(
+                    image=image,
+                    instance_map=instance_map,
+                    patch_size=patch_size,
+                    stride=stride,
+                )
+            expected = self._reference_patches(dataset)
+            self.assertGreater(len(expected), 0)
+            np.testing.assert_array_equal(dataset.patch_coordinates, expected[:, :2])
+            np.testing.assert_array_equal(dataset.patch_region_count, expected[:, 2])
+            np.testing.assert_array_equal(dataset.patch_instance_ids, expected[:, 3])
+            np.testing.assert_allclose(
+                dataset.patch_overlap, expected[:, 4] / (patch_size * patch_size))
+
+    def test_properties_match_regionprops(self):
+        """
+        Test the instance labels, bounding boxes and centroids against skimage.
+        """
+        rng = np.random.default_rng(1)
+        instance_map = rng.integers(0, 6, size=(30, 35)).astype(np.int32)
+        instance_map[instance_map == 3] = 0     # label gap
+        instance_map[instance_map == 5] = 9
+        instance_map[0, 0] = 12                 # one-pixel instance in a corner
+        expected = regionprops_table(instance_map, properties=("label", "bbox", "centroid"))
+        properties = InstanceMapPatchDataset._get_properties(instance_map)
+        self.assertEqual(set(properties), set(expected))
+        for name, values in expected.items():
+            np.testing.assert_allclose(properties[name], values, rtol=1e-12, err_msg=name)
+
+
+@unittest.skipUnless(torch.cuda.is_available(), "CUDA graphs need a CUDA device")
+class CUDAGraphTestCase(unittest.TestCase):
+    """CUDAGraphTestCase class."""
+
+    def test_cuda_graph_matches_eager(self):
+        """
+        Test that replaying the captured CUDA graph gives the eager embeddings,
+        for batches of varying size.
+        """
+        torch.manual_seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_path = os.path.join(tmp_dir, 'resnet18.pth')
+            torch.save(torchvision.models.resnet18().eval(), model_path)
+            device = torch.device('cuda:0')
+            eager_extractor = PatchFeatureExtractor(
+                model_path, device=device, patch_size=32)
+            graph_extractor = PatchFeatureExtractor(
+                model_path, device=device, patch_size=32, use_cuda_graph=True)
+
+        for batch_size in [8, 8, 5, 12, 12, 8, 3]:
+            patches = torch.rand(batch_size, 3, 32, 32)
+            np.testing.assert_allclose(
+                graph_extractor(patches).cpu().numpy(),
+                eager_extractor(patches).cpu().numpy(),
+                rtol=1e-5,
+                atol=1e-5,
+            )
+
+        # re-captured once when the batch of 12 appeared
+        self.assertEqual(graph_extractor.nr_graph_captures, 2)
+        self.assertEqual(eager_extractor.nr_graph_captures, 0)
+
+
 if __name__ == "__main__":
 
     unittest.main()
@@ -1,13 +1,17 @@
 """Unit test for preprocessing.tissue_mask"""
 import unittest
+import cv2
 import numpy as np
 import yaml
 import os
 from PIL import Image
 import shutil
+from scipy import ndimage
+from skimage.filters import threshold_otsu
 
 from histocartography import PipelineRunner
 from histocartography.preprocessing import GaussianTissueMask
+from histocartography.preprocessing.tissue_mask import _threshold_otsu_nonzero, get_tissue_mask
 from histocartography.utils import download_test_data
 
 
@@ -107,6 +111,84 @@ class TissueMaskTestCase(unittest.TestCase):
         """Tear down the tests."""
 
 
+class GetTissueMaskTestCase(unittest.TestCase):
+    """GetTissueMaskTestCase class."""
+
+    @staticmethod
+    def _uncropped_tissue_mask(image, n_thresholding_steps, sigma, min_size):
+        """Tissue mask computed on the whole thumbnail, without restricting it to the tissue bounding box."""
+        thumbnail = 255 - cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        radius = int(4 * sigma + 0.5)
+        for _ in range(n_thresholding_steps):
+            thumbnail = cv2.GaussianBlur(
+                thumbnail.astype(np.float32),
+                (2 * radius + 1, 2 * radius + 1),
+                sigmaX=sigma,
+                sigmaY=sigma,
+                borderType=cv2.BORDER_REPLICATE)
+            thresh = threshold_otsu(thumbnail[thumbnail > 0])
+            thumbnail[thumbnail < thresh] = 0
+        labeled, _ = ndimage.label(thumbnail > 0)
+        unique, counts = np.unique(labeled[labeled > 0], return_counts=True)
+        labeled[np.isin(labeled, unique[counts < min_size])] = 0
+        return labeled, labeled == unique[np.argmax(counts)]
+
+    def test_cropped_tissue_mask_matches_uncropped(self):
+        """
+        Test that restricting the smoothing to the tissue bounding box does not change the
+        tissue mask of a thumbnail with wide white margins.
+        """
+        rng = np.random.default_rng(0)
+        image = np.full((160, 200, 3), 255, dtype=np.uint8)
+        image[50:110, 70:140] = rng.integers(60, 200, size=(60, 70, 3))
+        image[52:58, 150:156] = 120     # small separate region
+        image[100:104, 40:44] = 90      # speck to be discarded
+
+        for n_thresholding_steps, sigma in [(2, 2.0), (3, 1.5), (2, 0.8)]:
+            labeled, mask = get_tissue_mask(
+                image,
+                n_thresholding_steps=n_thresholding_steps,
+                sigma=sigma,
+                min_size=30)
+            expected_labeled, expected_mask = self._uncropped_tissue_mask(
+                image, n_thresholding_steps, sigma, min_size=30)
+            self.assertEqual(labeled.shape, image.shape[:2])
+            np.testing.assert_array_equal(mask, expected_mask)
+            np.testing.assert_array_equal(labeled, expected_labeled)
+
+
+class ThresholdOtsuNonzeroTestCase(unittest.TestCase):
+    """ThresholdOtsuNonzeroTestCase class."""
+
+    def test_threshold_matches_skimage(self):
+        """
+        Test the histogram-based threshold against threshold_otsu of the non-zero pixels.
+        """
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            low, high = np.sort(rng.integers(0, 257, size=2))
+            thumbnail = rng.integers(low, max(high, low + 2), size=(40, 50)).astype(np.uint8)
+            thumbnail[rng.random(thumbnail.shape) < 0.3] = 0
+            self.assertEqual(
+                _threshold_otsu_nonzero(thumbnail),
+                threshold_otsu(thumbnail[thumbnail > 0]),
+            )
+
+    def test_threshold_special_thumbnails(self):
+        """
+        Test a thumbnail with a single non-zero value and an all-zero thumbnail.
+        """
+        thumbnail = np.zeros((10, 12), dtype=np.uint8)
+        thumbnail[2:5, 3:7] = 137
+        self.assertEqual(
+            _threshold_otsu_nonzero(thumbnail),
+            threshold_otsu(thumbnail[thumbnail > 0]),
+        )
+
+        with self.assertRaises(ValueError):
+            _threshold_otsu_nonzero(np.zeros((10, 12), dtype=np.uint8))
+
+
 if __name__ == "__main__":
 
     unittest.main()